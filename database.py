@@ -1,19 +1,59 @@
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import asyncpg
+from fastapi import HTTPException
+import orjson
 import os
+from typing import Optional
 
-# Puedes usar variables de entorno de Coolify para esto
-DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_NAME = "db_cotizador"
-DB_USER = "tu_usuario"
-DB_PASS = "tu_password"
+# Único pool asyncpg del proceso: todos los endpoints deben importarlo desde aquí
+# para no abrir pools paralelos contra Postgres / PgBouncer.
+pool: Optional[asyncpg.Pool] = None
 
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS,
-        cursor_factory=RealDictCursor # Para retornar diccionarios en vez de tuplas
+async def configurar_conexion(conn):
+    # jsonb <-> objetos Python con orjson (p. ej. auditoria_examenes.codigos_json)
+    await conn.set_type_codec(
+        "jsonb", schema="pg_catalog",
+        encoder=lambda v: orjson.dumps(v).decode(), decoder=orjson.loads
     )
-    return conn
\ No newline at end of file
+
+async def iniciar_pool():
+    global pool
+    if pool:
+        return pool
+    try:
+        pool = await asyncpg.create_pool(
+            host=os.getenv("POSTGRES_HOST"),
+            database=os.getenv("POSTGRES_DATABASE"),
+            user=os.getenv("POSTGRES_USER"),
+            password=os.getenv("POSTGRES_PASSWORD"),
+            port=int(os.getenv("POSTGRES_PORT", "5432")),
+            ssl=False,
+            min_size=int(os.getenv("POSTGRES_POOL_MIN", "2")),
+            max_size=int(os.getenv("POSTGRES_POOL_MAX", "20")),
+            # asyncpg prepara y cachea por conexión cada query (sin re-planificar en cada request).
+            # Detrás de PgBouncer en modo transaction requiere max_prepared_statements > 0
+            # (PgBouncer >= 1.21); si no está disponible, usar POSTGRES_STATEMENT_CACHE_SIZE=0.
+            statement_cache_size=int(os.getenv("POSTGRES_STATEMENT_CACHE_SIZE", "100")),
+            init=configurar_conexion
+        )
+    except Exception as e:
+        print(f"Error creando pool de conexiones: {e}")
+        pool = None
+    return pool
+
+async def cerrar_pool():
+    global pool
+    if pool:
+        await pool.close()
+        pool = None
+
+def conectar_db():
+    """Devuelve el pool de conexiones o falla con 500 si no está disponible"""
+    if not pool:
+        raise HTTPException(status_code=500, detail="Error de conexión a DB")
+    return pool
+
+async def get_conn():
+    """Dependencia: presta una conexión del pool durante el request y la devuelve siempre.
+    Si el endpoint falla dentro de conn.transaction(), asyncpg hace rollback antes de liberarla."""
+    async with conectar_db().acquire() as conn:
+        yield conn
@@ -1,14 +1,19 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from fastapi import Depends, FastAPI, HTTPException, Query
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
+from cachetools import TTLCache
 import os
-from typing import List, Optional
+from typing import Dict, List, Optional
 import uvicorn
-import json
+import orjson
 from datetime import datetime
+import database
+from database import conectar_db, get_conn
 
-app = FastAPI(title="Cerebro API - Policlínico Tabancura")
+app = FastAPI(title="Cerebro API - Policlínico Tabancura", default_response_class=ORJSONResponse)
+# Comprime las respuestas sobre 1 KB (listados de cotizaciones y auditoría)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 # --- MODELOS DE DATOS (SCHEMAS) ---
 
@@ -19,17 +24,29 @@ class DetalleBase(BaseModel):
 
 class ExamenItem(BaseModel):
     # Mapeo exacto de las claves que envía el data_editor de Streamlit
-    codigo_ingreso: str = Optional[str]
-    nombre_prestacion: str = Optional[str]
+    model_config = ConfigDict(populate_by_name=True, coerce_numbers_to_str=True)
+
+    codigo_ingreso: str = Field("", alias="Codigo Ingreso")
+    # Puede venir null desde el data_editor (celda vacía): se guarda NULL como antes
+    nombre_prestacion: Optional[str] = Field("", alias="Nombre prestación en Fonasa o Particular")
+
+class ItemIn(ExamenItem):
+    # Obligatorio: (folio_cotizacion, codigo_examen) es único y un código vacío fusionaría items
+    codigo_ingreso: str = Field(alias="Codigo Ingreso", min_length=1)
+    copago: int = Field(0, alias="Copago")
 
 class NuevaOrdenIn(BaseModel):
     folio_cotizacion: str
     rut_paciente: str
-    examenes: List[dict] # Recibe la lista de exámenes desde Streamlit
+    examenes: List[ExamenItem] # Recibe la lista de exámenes desde Streamlit
 
 class ActualizarCotizacionIn(BaseModel):
     folio: str
-    items: List[dict]
+    items: List[ItemIn]
+
+class DetalleBatchIn(BaseModel):
+    # Mismo tope que el LIMIT 100 de /cotizaciones/buscar
+    folios: List[str] = Field(max_length=100)
 
 class AuditoriaOrdenIn(BaseModel):
     rut_paciente: str
@@ -40,154 +57,265 @@ class AuditoriaOrdenIn(BaseModel):
 
 # --- LÓGICA DE CONEXIÓN ---
 
-def conectar_db():
-    try:
-        conn = psycopg2.connect(
-            host=os.getenv("POSTGRES_HOST"),
-            database=os.getenv("POSTGRES_DATABASE"),
-            user=os.getenv("POSTGRES_USER"),
-            password=os.getenv("POSTGRES_PASSWORD"),
-            port=os.getenv("POSTGRES_PORT", "5432"),
-            sslmode="disable"
-        )
-        return conn
-    except Exception as e:
-        print(f"Error de conexión: {e}")
+@app.on_event("startup")
+async def iniciar_pool():
+    pool = await database.iniciar_pool()
+    assert pool is not None, "No se pudo crear el pool de conexiones a Postgres"
+    print(f"Pool de conexiones listo (max_size={pool.get_max_size()} por worker)")
+
+@app.on_event("shutdown")
+async def cerrar_pool():
+    await database.cerrar_pool()
+
+def filas_a_dicts(rows):
+    """Convierte Records a dicts leyendo los nombres de columna una sola vez"""
+    if not rows:
+        return []
+    cols = list(rows[0].keys())
+    return [dict(zip(cols, r)) for r in rows]
+
+# --- CACHÉ ---
+
+UVICORN_WORKERS = int(os.getenv("UVICORN_WORKERS", "1"))
+
+# Detalle por folio; solo cambia vía /cotizaciones/actualizar, que invalida la entrada.
+# Es local al proceso: con varios workers (uvicorn --workers, gunicorn -w, ...) la
+# invalidación no llega a los demás. Por eso es opt-in: activar con CACHE_DETALLE=1
+# solo cuando la API corre en un único proceso (hasta tener Redis GET/SETEX).
+CACHE_DETALLE_ACTIVA = os.getenv("CACHE_DETALLE", "0") == "1"
+_detalle_cache = TTLCache(maxsize=10_000, ttl=60)
+# Lecturas en curso por folio: [lectores, generación]. La generación sube al invalidar, para
+# no guardar un detalle leído antes de un /cotizaciones/actualizar que terminó durante la
+# consulta. Solo hay entradas mientras hay lecturas en vuelo, así que no crece sin límite.
+_lecturas_en_curso: Dict[str, List[int]] = {}
+
+def leer_detalle_cache(folio):
+    if not CACHE_DETALLE_ACTIVA:
+        return None
+    # .get() y no `in` + []: la entrada del TTLCache puede expirar entre ambas llamadas
+    return _detalle_cache.get(folio)
+
+def iniciar_lectura_detalle(folio):
+    """Registra una lectura a la BD y devuelve la generación con la que empezó"""
+    if not CACHE_DETALLE_ACTIVA:
         return None
+    entrada = _lecturas_en_curso.setdefault(folio, [0, 0])
+    entrada[0] += 1
+    return entrada[1]
+
+def terminar_lectura_detalle(folio, generacion, detalle=None):
+    """Guarda el detalle si el folio no se invalidó durante la lectura; llamar siempre (finally)"""
+    entrada = _lecturas_en_curso.get(folio)
+    if entrada is None:
+        return
+    if detalle is not None and entrada[1] == generacion:
+        _detalle_cache[folio] = detalle
+    entrada[0] -= 1
+    if entrada[0] == 0:
+        del _lecturas_en_curso[folio]
+
+def invalidar_detalle_cache(folio):
+    if not CACHE_DETALLE_ACTIVA:
+        return
+    entrada = _lecturas_en_curso.get(folio)
+    if entrada:
+        entrada[1] += 1
+    _detalle_cache.pop(folio, None)
+
+# Sobre este número de items, /cotizaciones/actualizar usa COPY en vez de INSERT
+UMBRAL_COPY = 200
 
 # --- ENDPOINTS ---
 
 @app.get("/cotizaciones/buscar/{rut}")
-def buscar_cotizaciones_por_rut(rut: str):
-    conn = conectar_db()
-    if not conn: raise HTTPException(status_code=500, detail="Error de conexión a DB")
+async def buscar_cotizaciones_por_rut(rut: str, conn=Depends(get_conn)):
     try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        query = "SELECT * FROM cotizaciones WHERE documento_id = %s ORDER BY fecha_cotizacion DESC"
-        cur.execute(query, (rut,))
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return rows
+        query = """
+            SELECT folio, documento_id, nombre_paciente, fecha_cotizacion, total_copago
+            FROM cotizaciones WHERE documento_id = $1
+            ORDER BY fecha_cotizacion DESC LIMIT 100
+        """
+        rows = await conn.fetch(query, rut)
+        return filas_a_dicts(rows)
     except Exception as e:
-        if conn: conn.close()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/cotizaciones/detalle/{folio}", response_model=List[DetalleBase])
-def obtener_detalle_cotizacion(folio: str):
-    conn = conectar_db()
-    if not conn: raise HTTPException(status_code=500, detail="Error de conexión a DB")
+async def obtener_detalle_cotizacion(folio: str):
+    detalle = leer_detalle_cache(folio)
+    if detalle is not None:
+        return detalle
+    # Sin get_conn: solo se toma una conexión del pool si no hay hit en la caché
+    pool = conectar_db()
+    generacion = iniciar_lectura_detalle(folio)
+    try:
+        async with pool.acquire() as conn:
+            query = "SELECT codigo_examen, nombre_examen, valor_copago FROM detalle_cotizaciones WHERE folio_cotizacion = $1"
+            rows = await conn.fetch(query, folio)
+        detalle = filas_a_dicts(rows)
+        return detalle
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        terminar_lectura_detalle(folio, generacion, detalle)
+
+@app.post("/cotizaciones/detalle/batch", response_model=Dict[str, List[DetalleBase]])
+async def obtener_detalle_cotizaciones_batch(data: DetalleBatchIn):
+    """Detalle de varios folios en una sola consulta, agrupado por folio"""
+    resultado = {}
+    for f in dict.fromkeys(data.folios):
+        detalle = leer_detalle_cache(f)
+        if detalle is not None:
+            resultado[f] = detalle
+    pendientes = [f for f in dict.fromkeys(data.folios) if f not in resultado]
+    if not pendientes:
+        return resultado
+    pool = conectar_db()
+    generaciones = {f: iniciar_lectura_detalle(f) for f in pendientes}
+    detalles = None  # solo se cachea si la consulta y el agrupado terminan completos
     try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        query = "SELECT codigo_examen, nombre_examen, valor_copago FROM detalle_cotizaciones WHERE folio_cotizacion = %s"
-        cur.execute(query, (folio,))
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return rows
+        async with pool.acquire() as conn:
+            query = """
+                SELECT folio_cotizacion, codigo_examen, nombre_examen, valor_copago
+                FROM detalle_cotizaciones WHERE folio_cotizacion = ANY($1::text[])
+            """
+            rows = await conn.fetch(query, pendientes)
+        agrupados = {f: [] for f in pendientes}
+        for r in rows:
+            agrupados[r["folio_cotizacion"]].append({
+                "codigo_examen": r["codigo_examen"],
+                "nombre_examen": r["nombre_examen"],
+                "valor_copago": r["valor_copago"]
+            })
+        detalles = agrupados
+        resultado.update(detalles)
+        return resultado
     except Exception as e:
-        if conn: conn.close()
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        for f in pendientes:
+            terminar_lectura_detalle(f, generaciones[f], detalles[f] if detalles else None)
 
 @app.post("/cotizaciones/actualizar")
-def actualizar_cotizacion(data: ActualizarCotizacionIn):
-    conn = conectar_db()
-    if not conn: raise HTTPException(status_code=500, detail="Error de conexión a DB")
+async def actualizar_cotizacion(data: ActualizarCotizacionIn, conn=Depends(get_conn)):
     try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM detalle_cotizaciones WHERE folio_cotizacion = %s", (data.folio,))
-        for item in data.items:
-            cur.execute("""
-                INSERT INTO detalle_cotizaciones (folio_cotizacion, codigo_examen, nombre_examen, valor_copago)
-                VALUES (%s, %s, %s, %s)
-            """, (
-                data.folio, 
-                str(item.get('Codigo Ingreso', '')), 
-                item.get('Nombre prestación en Fonasa o Particular', ''),
-                int(item.get('Copago', 0))
-            ))
-        conn.commit()
-        cur.close()
-        conn.close()
+        async with conn.transaction():
+            values = [
+                (data.folio, i.codigo_ingreso, i.nombre_prestacion, i.copago)
+                for i in data.items
+            ]
+            if len(values) > UMBRAL_COPY:
+                # Lote grande: reemplazo completo vía COPY (binario), el camino más rápido.
+                # Se deduplica por código para respetar el índice único, como haría el upsert.
+                await conn.execute("DELETE FROM detalle_cotizaciones WHERE folio_cotizacion = $1", data.folio)
+                await conn.copy_records_to_table(
+                    "detalle_cotizaciones",
+                    records=list({v[1]: v for v in values}.values()),
+                    columns=["folio_cotizacion", "codigo_examen", "nombre_examen", "valor_copago"]
+                )
+            else:
+                # 1. Upsert de los items recibidos (executemany = un solo round-trip)
+                await conn.executemany("""
+                    INSERT INTO detalle_cotizaciones (folio_cotizacion, codigo_examen, nombre_examen, valor_copago)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (folio_cotizacion, codigo_examen) DO UPDATE
+                    SET nombre_examen = EXCLUDED.nombre_examen, valor_copago = EXCLUDED.valor_copago
+                """, values)
+                # 2. Eliminar solo los items que ya no vienen en la cotización
+                await conn.execute("""
+                    DELETE FROM detalle_cotizaciones
+                    WHERE folio_cotizacion = $1 AND codigo_examen <> ALL($2::text[])
+                """, data.folio, [v[1] for v in values])
+        invalidar_detalle_cache(data.folio)
         return {"status": "success"}
     except Exception as e:
-        if conn: conn.close()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/ordenes/nueva", status_code=201)
-def crear_nueva_orden_clinica(data: NuevaOrdenIn):
+async def crear_nueva_orden_clinica(data: NuevaOrdenIn, conn=Depends(get_conn)):
     """Inserta la orden y sus detalles devolviendo el Folio SERIAL generado"""
-    conn = conectar_db()
-    if not conn: raise HTTPException(status_code=500, detail="Error de conexión")
     try:
-        cur = conn.cursor()
-        # 1. Insertar Cabecera y obtener Folio SERIAL
-        query_cabecera = """
-            INSERT INTO ordenes_clinicas (folio_cotizacion_origen, rut_paciente)
-            VALUES (%s, %s) RETURNING folio_orden
-        """
-        cur.execute(query_cabecera, (data.folio_cotizacion, data.rut_paciente))
-        nuevo_folio = cur.fetchone()[0]
-
-        # 2. Insertar Detalles
-        query_detalle = """
-            INSERT INTO ordenes_detalles (folio_orden, codigo_examen, nombre_examen)
-            VALUES (%s, %s, %s)
+        # Cabecera y detalles en un único statement (un round-trip sin importar N)
+        query = """
+            WITH cabecera AS (
+                INSERT INTO ordenes_clinicas (folio_cotizacion_origen, rut_paciente)
+                VALUES ($1, $2) RETURNING folio_orden
+            ), detalles AS (
+                INSERT INTO ordenes_detalles (folio_orden, codigo_examen, nombre_examen)
+                SELECT cabecera.folio_orden, d.codigo, d.nombre
+                FROM cabecera CROSS JOIN UNNEST($3::text[], $4::text[]) AS d(codigo, nombre)
+            )
+            SELECT folio_orden FROM cabecera
         """
-        for examen in data.examenes:
-            cur.execute(query_detalle, (
-                nuevo_folio,
-                str(examen.get('Codigo Ingreso', '')),
-                examen.get('Nombre prestación en Fonasa o Particular', '')
-            ))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        nuevo_folio = await conn.fetchval(query,
+            data.folio_cotizacion, data.rut_paciente,
+            [ex.codigo_ingreso for ex in data.examenes],
+            [ex.nombre_prestacion for ex in data.examenes]
+        )
         return {"status": "success", "folio_orden": nuevo_folio}
     except Exception as e:
-        if conn: 
-            conn.rollback()
-            conn.close()
         raise HTTPException(status_code=500, detail=f"Error en transacción: {str(e)}")
 
 @app.post("/auditoria/ordenes")
-def registrar_auditoria(audit: AuditoriaOrdenIn):
-    conn = conectar_db()
-    if not conn: raise HTTPException(status_code=500, detail="Error de conexión")
+async def registrar_auditoria(audit: AuditoriaOrdenIn, conn=Depends(get_conn)):
     try:
-        cur = conn.cursor()
         query = """
             INSERT INTO auditoria_examenes 
             (rut_paciente, nombre_paciente, folio_origen, cantidad_examenes, codigos_json)
-            VALUES (%s, %s, %s, %s, %s)
+            VALUES ($1, $2, $3, $4, $5::jsonb)
         """
-        cur.execute(query, (
+        await conn.execute(query,
             audit.rut_paciente, audit.nombre_paciente, audit.folio_origen,
-            audit.cantidad_examenes, json.dumps(audit.codigos)
-        ))
-        conn.commit()
-        cur.close()
-        conn.close()
+            audit.cantidad_examenes, audit.codigos
+        )
         return {"status": "success"}
     except Exception as e:
-        if conn: conn.close()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/auditoria/historial")
-def obtener_historial_auditoria():
-    conn = conectar_db()
-    if not conn: raise HTTPException(status_code=500, detail="Error de conexión")
+async def obtener_historial_auditoria(
+    antes: Optional[datetime] = None,
+    antes_id: Optional[int] = None,
+    limite: int = Query(500, ge=1, le=500),
+    conn=Depends(get_conn)
+):
+    """Historial paginado por keyset: pasar fecha_emision e id del último registro en `antes` / `antes_id`.
+    Se responde como NDJSON (un registro por línea)."""
+    if (antes is None) != (antes_id is None):
+        raise HTTPException(status_code=422, detail="antes y antes_id deben enviarse juntos")
+    columnas = "id, rut_paciente, nombre_paciente, folio_origen, cantidad_examenes, codigos_json, fecha_emision"
+    # id desempata registros con la misma fecha_emision para no saltarlos entre páginas
+    if antes:
+        query = f"""
+            SELECT {columnas} FROM auditoria_examenes
+            WHERE (fecha_emision, id) < ($1, $2)
+            ORDER BY fecha_emision DESC, id DESC LIMIT $3
+        """
+        args = (antes, antes_id, limite)
+    else:
+        query = f"SELECT {columnas} FROM auditoria_examenes ORDER BY fecha_emision DESC, id DESC LIMIT $1"
+        args = (limite,)
+
+    # La página (máx. 500 filas) se lee completa y la conexión vuelve al pool al terminar el
+    # handler, sin quedar tomada mientras un cliente lento descarga la respuesta.
     try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT * FROM auditoria_examenes ORDER BY fecha_emision DESC")
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return rows
+        rows = await conn.fetch(query, *args)
     except Exception as e:
-        if conn: conn.close()
         raise HTTPException(status_code=500, detail=str(e))
 
+    cols = list(rows[0].keys()) if rows else []
+
+    def generar():
+        for r in rows:
+            yield orjson.dumps(dict(zip(cols, r))) + b"\n"
+
+    return StreamingResponse(generar(), media_type="application/x-ndjson")
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Con varios workers cada uno abre su propio pool (POSTGRES_POOL_MAX por worker):
+    # dimensionar contra PgBouncer / max_connections de Postgres.
+    uvicorn.run(
+        "main:app", host="0.0.0.0", port=8000,
+        loop="uvloop", http="httptools",
+        workers=UVICORN_WORKERS
+    )
\ No newline at end of file
@@ -0,0 +1,4 @@
+-- Requerido por el upsert de /cotizaciones/actualizar (ON CONFLICT).
+-- Si existen filas duplicadas por (folio_cotizacion, codigo_examen) hay que depurarlas antes.
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_detcot_folio_codigo
+    ON detalle_cotizaciones (folio_cotizacion, codigo_examen);
@@ -0,0 +1,17 @@
+-- Índices para los WHERE / ORDER BY de main.py.
+-- CONCURRENTLY no puede ir dentro de una transacción: ejecutar statement por statement.
+
+-- /cotizaciones/buscar/{rut}: WHERE documento_id = $1 ORDER BY fecha_cotizacion DESC
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_cotiz_doc_fecha
+    ON cotizaciones (documento_id, fecha_cotizacion DESC);
+
+-- /cotizaciones/detalle/{folio}: WHERE folio_cotizacion = $1
+-- Cubierto por uq_detcot_folio_codigo (001), cuya primera columna es folio_cotizacion.
+
+-- /auditoria/historial: WHERE (fecha_emision, id) < ($1, $2) ORDER BY fecha_emision DESC, id DESC
+-- (si ya existía idx_audex_fecha solo sobre fecha_emision, eliminarlo antes con DROP INDEX CONCURRENTLY)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_audex_fecha
+    ON auditoria_examenes (fecha_emision DESC, id DESC);
+
+-- Verificación (debe mostrar Index Scan usando idx_cotiz_doc_fecha):
+-- EXPLAIN ANALYZE SELECT * FROM cotizaciones WHERE documento_id = '11111111-1' ORDER BY fecha_cotizacion DESC;
@@ -0,0 +1,3 @@
+-- codigos_json pasa de TEXT a jsonb; la API envía y recibe la lista directamente
+ALTER TABLE auditoria_examenes
+    ALTER COLUMN codigos_json TYPE jsonb USING codigos_json::jsonb;